@@ -15,22 +15,29 @@ Adds:
 """
 
 import argparse
+import hashlib
 import os
+import shutil
 import sys
 import json
 import math
+from functools import lru_cache
 from dataclasses import dataclass
-from typing import List, Dict, Any
+from typing import Any, Callable, Dict, List, Tuple
 
 import torch
-from datasets import load_dataset, DatasetDict, concatenate_datasets
+import torch.nn as nn
+from datasets import Dataset, load_dataset, load_from_disk, DatasetDict, concatenate_datasets
 
 from transformers import (
+    AutoConfig,
     AutoTokenizer,
     AutoModelForCausalLM,
+    DataCollatorForLanguageModeling,
     Trainer,
     TrainingArguments,
 )
+from transformers.pytorch_utils import Conv1D
 
 # BitsAndBytes dynamic import
 HAS_BNB = False
@@ -40,6 +47,22 @@ try:
 except:
     BitsAndBytesConfig = None
 
+# xxhash dynamic import (dedup hashing, blake2b fallback)
+HAS_XXHASH = False
+try:
+    import xxhash
+    HAS_XXHASH = True
+except ImportError:
+    xxhash = None
+
+# FlashAttention-2 dynamic import
+HAS_FLASH_ATTN = False
+try:
+    import flash_attn  # noqa: F401
+    HAS_FLASH_ATTN = True
+except ImportError:
+    pass
+
 try:
     from peft import (
         LoraConfig,
@@ -50,6 +73,24 @@ except:
     print("[ASX-QLORA++] ERROR: Install 'peft' → pip install peft")
     raise
 
+# Fast JSON: orjson, else stdlib json configured to emit identical
+# text (compact, sorted, unescaped UTF-8) so training text and dedup
+# hashes do not depend on which package is installed
+def _dumps_stdlib(obj: Any) -> str:
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+try:
+    import orjson
+
+    def _dumps(obj: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+except ImportError:
+    _dumps = _dumps_stdlib
+
+# Tokenization workers (leave one core for the main process)
+NUM_PROC = max(1, (os.cpu_count() or 2) - 1)
+
 # ---------------------------------------------------------
 # MODEL PRESETS
 # ---------------------------------------------------------
@@ -81,6 +122,11 @@ class UltraQLoRAConfig:
     lora_r: int = 64
     lora_alpha: int = 16
     lora_dropout: float = 0.05
+    pack: bool = True
+    compile: bool = True
+    force_qlora: bool = False
+    stream: bool = False
+    dedup: bool = True
 
 
 def parse_args():
@@ -112,6 +158,31 @@ def parse_args():
     parser.add_argument("--lora-r", type=int, default=64)
     parser.add_argument("--lora-alpha", type=int, default=16)
     parser.add_argument("--lora-dropout", type=float, default=0.05)
+    parser.add_argument(
+        "--no-pack",
+        action="store_true",
+        help="Truncate/pad per record instead of packing into max-seq-len blocks",
+    )
+    parser.add_argument(
+        "--no-compile",
+        action="store_true",
+        help="Disable torch.compile of the PEFT model (never applied under QLoRA)",
+    )
+    parser.add_argument(
+        "--force-qlora",
+        action="store_true",
+        help="Use 4-bit QLoRA even for models below the size threshold",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream .jsonl/.txt/.tar (WebDataset) shards instead of loading them into memory",
+    )
+    parser.add_argument(
+        "--no-dedup",
+        action="store_true",
+        help="Keep duplicate records (dedup runs on the in-memory path only)",
+    )
 
     args = parser.parse_args()
 
@@ -140,6 +211,11 @@ def parse_args():
         lora_r=args.lora_r,
         lora_alpha=args.lora_alpha,
         lora_dropout=args.lora_dropout,
+        pack=not args.no_pack,
+        compile=not args.no_compile,
+        force_qlora=args.force_qlora,
+        stream=args.stream,
+        dedup=not args.no_dedup,
     )
 
     return cfg
@@ -150,52 +226,118 @@ def parse_args():
 
 def flatten_obj(obj: Any) -> str:
     """Turn dict/list into stable deterministic string."""
-    if isinstance(obj, dict):
-        return json.dumps(obj, sort_keys=True)
-    if isinstance(obj, list):
-        return json.dumps(obj, sort_keys=True)
+    if isinstance(obj, (dict, list)):
+        return _dumps(obj)
     return str(obj)
 
 
+def _fmt_prompt_completion(record: Dict[str, Any]) -> str:
+    return f"User: {record['prompt']}\nAssistant: {record['completion']}"
+
+
+def _fmt_instruction(record: Dict[str, Any]) -> str:
+    inp = record.get("input", "")
+    if inp:
+        return f"Instruction: {record['instruction']}\nInput: {inp}\nOutput: {record['output']}"
+    return f"Instruction: {record['instruction']}\nOutput: {record['output']}"
+
+
+def _fmt_flatten(record: Dict[str, Any]) -> str:
+    parts = []
+    for k, v in record.items():
+        if isinstance(v, (str, int, float)):
+            parts.append(f"{k}: {v}")
+        else:
+            parts.append(f"{k}: {flatten_obj(v)}")
+
+    return "\n".join(parts)
+
+
 def extract_text(record: Dict[str, Any]) -> str:
+    # WebDataset sample: {"__key__", "__url__", "<ext>": payload}
+    if "__key__" in record:
+        if isinstance(record.get("json"), dict):
+            return extract_text(record["json"])
+        for ext in ("txt", "text"):
+            if isinstance(record.get(ext), str):
+                return record[ext]
+
     # Common direct
     if "text" in record and isinstance(record["text"], str):
         return record["text"]
 
     # prompt + completion
     if "prompt" in record and "completion" in record:
-        return f"User: {record['prompt']}\nAssistant: {record['completion']}"
+        return _fmt_prompt_completion(record)
 
     # instruction formats
     if "instruction" in record and "output" in record:
-        inp = record.get("input", "")
-        if inp:
-            return f"Instruction: {record['instruction']}\nInput: {inp}\nOutput: {record['output']}"
-        return f"Instruction: {record['instruction']}\nOutput: {record['output']}"
+        return _fmt_instruction(record)
 
     # fallback: flatten everything
-    parts = []
-    for k, v in record.items():
-        if isinstance(v, (str, int, float)):
-            parts.append(f"{k}: {v}")
-        else:
-            parts.append(f"{k}: {flatten_obj(v)}")
+    return _fmt_flatten(record)
 
-    return "\n".join(parts)
 
+def _fmt_text(record: Dict[str, Any]) -> str:
+    text = record["text"]
+    return text if isinstance(text, str) else extract_text(record)
+
+
+@lru_cache(maxsize=None)
+def _pick_formatter(keys: Tuple[str, ...]) -> Callable[[Dict[str, Any]], str]:
+    """Resolve extract_text's branch once per column schema.
+
+    Arrow batches carry every column on every row, so key presence is
+    fixed per schema; only the text-is-str check stays per row.
+    """
+    if "__key__" in keys:
+        return extract_text
+    if "text" in keys:
+        return _fmt_text
+    if "prompt" in keys and "completion" in keys:
+        return _fmt_prompt_completion
+    if "instruction" in keys and "output" in keys:
+        return _fmt_instruction
+    return _fmt_flatten
+
+
+def batch_texts(batch: Dict[str, List[Any]]) -> List[str]:
+    keys = tuple(batch.keys())
+
+    # plain-text schema (.txt corpora): the column already is the text
+    if keys == ("text",):
+        texts = batch["text"]
+        if all(isinstance(t, str) for t in texts):
+            return texts
+
+    fmt = _pick_formatter(keys)
+    return [fmt(r) for r in _rows(batch)]
 
-def load_ultra_dataset(paths: List[str]):
+
+def data_ext(path: str) -> str:
+    """File extension, looking through .zst/.gz compression suffixes."""
+    root, ext = os.path.splitext(path.lower())
+    if ext in (".zst", ".gz"):
+        ext = os.path.splitext(root)[1]
+    return ext
+
+
+def load_ultra_dataset(paths: List[str], streaming: bool = False):
     datasets = []
     for p in paths:
         if not os.path.exists(p):
             print("[QLORA++] WARNING: missing", p)
             continue
 
-        ext = os.path.splitext(p)[1].lower()
+        ext = data_ext(p)
         if ext in [".json", ".jsonl"]:
-            ds = load_dataset("json", data_files=p, split="train")
+            ds = load_dataset("json", data_files=p, split="train", streaming=streaming)
         elif ext == ".txt":
-            ds = load_dataset("text", data_files=p, split="train")
+            ds = load_dataset("text", data_files=p, split="train", streaming=streaming)
+        elif ext == ".tar":
+            if not streaming:
+                raise RuntimeError(f"WebDataset shard {p} requires --stream")
+            ds = load_dataset("webdataset", data_files=p, split="train", streaming=True)
         else:
             print("[QLORA++] WARN: skipping", p)
             continue
@@ -205,37 +347,311 @@ def load_ultra_dataset(paths: List[str]):
     if not datasets:
         raise RuntimeError("No datasets loaded")
 
-    merged = concatenate_datasets(datasets)
+    # raw rows; extract_text + tokenize happen in one pass in train()
+    return concatenate_datasets(datasets)
+
+
+def _rows(batch: Dict[str, List[Any]]):
+    """Yield per-row dicts from a columnar batch."""
+    keys = list(batch.keys())
+    for values in zip(*batch.values()):
+        yield dict(zip(keys, values))
+
+
+def hash_text(text: str) -> int:
+    """64-bit content hash used for dedup."""
+    data = text.encode()
+    if HAS_XXHASH:
+        return xxhash.xxh3_64_intdigest(data)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
 
-    # wrap raw row
-    def wrap_raw(batch):
-        return {"__raw__": batch}
+def dedup_dataset(ds: Dataset) -> Dataset:
+    """Drop records whose extracted text was already seen (first wins)."""
+    seen = set()
 
-    wrapped = merged.map(wrap_raw, batched=True, batch_size=1000)
+    def keep(batch):
+        mask = []
+        for text in batch_texts(batch):
+            h = hash_text(text)
+            mask.append(h not in seen)
+            seen.add(h)
+        return mask
+
+    before = len(ds)
+    # single process: `seen` must be shared across every batch
+    ds = ds.filter(keep, batched=True, batch_size=2000)
+    print(f"[GODMODE] Dedup: {before} → {len(ds)} records")
+    return ds
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(tok_name: str):
+    """Build (once per process) the tokenizer used for training."""
+    tokenizer = AutoTokenizer.from_pretrained(tok_name, use_fast=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "right"
+    tokenizer.deprecation_warnings["Asking-to-pad"] = True
+    return tokenizer
+
+
+def _tokenize(batch: Dict[str, List[Any]], tok_name: str, max_len: int, pack: bool = False):
+    # resolved inside the worker so the tokenizer is never pickled
+    tokenizer = get_tokenizer(tok_name)
+    texts = batch_texts(batch)
+
+    if pack:
+        # full token streams + EOS separator; _pack re-chunks them
+        res = tokenizer(texts, add_special_tokens=False, return_attention_mask=False)
+        eos = tokenizer.eos_token_id
+        return {"input_ids": [ids + [eos] for ids in res["input_ids"]]}
+
+    res = tokenizer(
+        texts,
+        max_length=max_len,
+        truncation=True,
+        padding=False,
+        # labels and attention_mask are rebuilt per batch by the collator
+        return_attention_mask=False,
+    )
+    # consumed by group_by_length's sampler, dropped again at collate time
+    res["length"] = [len(ids) for ids in res["input_ids"]]
+    return res
+
+
+def tokenized_cache_key(cfg: UltraQLoRAConfig) -> str:
+    """Fingerprint of everything the tokenized dataset depends on."""
+    h = hashlib.sha1()
+    h.update(f"{cfg.model_name}|{cfg.max_seq_len}|{cfg.pack}|{cfg.dedup}".encode())
+    for p in cfg.data_files:
+        if os.path.exists(p):
+            st = os.stat(p)
+            h.update(f"|{os.path.abspath(p)}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+def _pack(batch: Dict[str, List[Any]], block_size: int):
+    """Concatenate token streams and re-chunk into block_size blocks."""
+    stream = [t for ids in batch["input_ids"] for t in ids]
+    blocks = [stream[i:i + block_size] for i in range(0, len(stream), block_size)]
+    return {"input_ids": blocks}
+
+
+def build_tokenized_dataset(cfg: UltraQLoRAConfig) -> Dataset:
+    """Tokenized (and packed) dataset, memory-mapped from .cache on reruns.
+
+    The cache is checked before any raw data is loaded, so a hit skips
+    loading, dedup and tokenization entirely.
+    """
+    cache_dir = os.path.join(cfg.out_dir, ".cache")
+    cached = os.path.join(cache_dir, f"tokenized-{tokenized_cache_key(cfg)}")
+    if os.path.isdir(cached):
+        print("[GODMODE] Tokenized cache HIT:", cached)
+        return load_from_disk(cached)
+
+    print("[GODMODE] Tokenized cache MISS, building", cached)
+    raw = load_ultra_dataset(cfg.data_files)
+    if cfg.dedup:
+        raw = dedup_dataset(raw)
+
+    # Convert raw→tokenized (single pass, source columns dropped)
+    tokenized = raw.map(
+        _tokenize,
+        batched=True,
+        batch_size=1000,
+        fn_kwargs={
+            "tok_name": cfg.model_name,
+            "max_len": cfg.max_seq_len,
+            "pack": cfg.pack,
+        },
+        remove_columns=raw.column_names,
+        num_proc=NUM_PROC,
+    )
 
-    # tokenize later
-    return wrapped
+    if cfg.pack:
+        # every block is max_seq_len real tokens (only a batch tail is shorter)
+        tokenized = tokenized.map(
+            _pack,
+            batched=True,
+            batch_size=1000,
+            fn_kwargs={"block_size": cfg.max_seq_len},
+            remove_columns=tokenized.column_names,
+            num_proc=NUM_PROC,
+        )
+        print(f"[GODMODE] Packed into {len(tokenized)} blocks of {cfg.max_seq_len} tokens")
+
+    # write to a temp dir first so a partial save is never a cache hit
+    tmp = cached + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tokenized.save_to_disk(tmp)
+    os.replace(tmp, cached)
+
+    # reload so training reads the memory-mapped copy
+    return load_from_disk(cached)
+
+
+def build_stream_dataset(cfg: UltraQLoRAConfig):
+    """Lazily tokenized (and packed) IterableDataset with a shuffle buffer."""
+    raw = load_ultra_dataset(cfg.data_files, streaming=True)
+    # features are often unknown for streamed json; peek at the first row
+    columns = raw.column_names or list(next(iter(raw)).keys())
+
+    stream = raw.map(
+        _tokenize,
+        batched=True,
+        batch_size=1000,
+        fn_kwargs={
+            "tok_name": cfg.model_name,
+            "max_len": cfg.max_seq_len,
+            "pack": cfg.pack,
+        },
+        remove_columns=columns,
+    )
+    if cfg.pack:
+        stream = stream.map(
+            _pack,
+            batched=True,
+            batch_size=1000,
+            fn_kwargs={"block_size": cfg.max_seq_len},
+            remove_columns=["input_ids"],
+        )
+    return stream.shuffle(seed=42, buffer_size=10_000)
 
 
 # ---------------------------------------------------------
 # MODEL LOADER
 # ---------------------------------------------------------
 
-TARGET_MODULES_QWEN = [
+# Attention/MLP projection names across Llama/Qwen, Baichuan, MPT/Phi, GPT-2
+LORA_TARGET_CANDIDATES = [
     "q_proj", "k_proj", "v_proj", "o_proj",
-    "gate_proj", "up_proj", "down_proj"
+    "gate_proj", "up_proj", "down_proj",
+    "Wqkv", "W_pack", "c_attn", "c_proj",
 ]
 
 
-def load_model(cfg: UltraQLoRAConfig):
-    device = (
-        "cuda" if cfg.device == "auto" and torch.cuda.is_available()
-        else cfg.device
+def discover_lora_targets(model) -> List[str]:
+    """Collect the projection module names LoRA should attach to.
+
+    Linear4bit subclasses nn.Linear, so quantized models are covered too.
+    If none of the standard names exist, every linear layer except the
+    output head is used.
+    """
+    found = []
+    for name, module in model.named_modules():
+        if not isinstance(module, (nn.Linear, Conv1D)):
+            continue
+        short = name.rsplit(".", 1)[-1]
+        if short not in found:
+            found.append(short)
+
+    targets = [n for n in LORA_TARGET_CANDIDATES if n in found]
+    if not targets:
+        targets = [n for n in found if n != "lm_head"]
+    if not targets:
+        raise RuntimeError("No LoRA target modules found")
+
+    print("[GODMODE] LoRA targets:", ", ".join(targets))
+    return targets
+
+
+# Below this size NF4 dequant overhead outweighs the memory savings
+QLORA_MIN_PARAMS = 3_000_000_000
+
+
+def estimate_params(model_name: str) -> int:
+    """Rough parameter count from the model config (no weights downloaded)."""
+    conf = AutoConfig.from_pretrained(model_name)
+    h = conf.hidden_size
+    layers = conf.num_hidden_layers
+    inter = getattr(conf, "intermediate_size", None)
+
+    # attention q/k/v/o + (gated) MLP per layer, plus embeddings
+    per_layer = 4 * h * h + (3 * h * inter if inter else 8 * h * h)
+    return layers * per_layer + conf.vocab_size * h
+
+
+# Pre-quantized NF4 snapshots, reused across runs on the same base model
+QLORA_CACHE_ROOT = os.environ.get(
+    "ASX_QLORA_CACHE", os.path.expanduser("~/.cache/asx_qlora")
+)
+
+
+def qlora_snapshot_dir(model_name: str) -> str:
+    key = hashlib.sha1((model_name + "nf4-dq-bf16").encode()).hexdigest()
+    return os.path.join(QLORA_CACHE_ROOT, key)
+
+
+def load_quantized(model_name: str, bnb_config, load_kwargs: Dict[str, Any]):
+    """Load the 4-bit base model, from the local snapshot when present."""
+    snap = qlora_snapshot_dir(model_name)
+    if os.path.exists(os.path.join(snap, "config.json")):
+        print("[GODMODE] 4-bit snapshot cache HIT:", snap)
+        model = AutoModelForCausalLM.from_pretrained(
+            snap,
+            quantization_config=bnb_config,
+            device_map="auto",
+            **load_kwargs,
+        )
+        # saved adapters must name the hub model, not the local snapshot
+        model.config._name_or_path = model_name
+        model.name_or_path = model_name
+        return model
+
+    print("[GODMODE] 4-bit snapshot cache MISS, quantizing", model_name)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        quantization_config=bnb_config,
+        device_map="auto",
+        **load_kwargs,
     )
+
+    # write to a temp dir first so a partial save is never a cache hit
+    tmp = snap + ".tmp"
+    try:
+        model.save_pretrained(tmp)
+        os.replace(tmp, snap)
+        print("[GODMODE] Saved 4-bit snapshot:", snap)
+    except Exception as e:
+        shutil.rmtree(tmp, ignore_errors=True)
+        print("[GODMODE] WARN: could not save 4-bit snapshot:", e)
+
+    return model
+
+
+def resolve_device(cfg: UltraQLoRAConfig) -> str:
+    if cfg.device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return cfg.device
+
+
+def load_model(cfg: UltraQLoRAConfig):
+    device = resolve_device(cfg)
     print("[GODMODE] Using device:", device)
 
     use_qlora = (device == "cuda" and HAS_BNB)
 
+    # without bf16 (T4/V100) the alternative to NF4 is an fp32 load, so keep 4-bit
+    if use_qlora and not cfg.force_qlora and torch.cuda.is_bf16_supported():
+        est_params = estimate_params(cfg.model_name)
+        if est_params < QLORA_MIN_PARAMS:
+            print(
+                f"[GODMODE] ~{est_params / 1e9:.2f}B params < "
+                f"{QLORA_MIN_PARAMS / 1e9:.0f}B: NF4 dequant would slow training, "
+                "using BF16 LoRA (--force-qlora to override)"
+            )
+            use_qlora = False
+
+    # FA2 (Ampere+ / bf16) when available, PyTorch SDPA otherwise
+    load_kwargs = {}
+    if device == "cuda" and torch.cuda.is_bf16_supported():
+        load_kwargs["torch_dtype"] = torch.bfloat16
+        load_kwargs["attn_implementation"] = (
+            "flash_attention_2" if HAS_FLASH_ATTN else "sdpa"
+        )
+        print("[GODMODE] Attention:", load_kwargs["attn_implementation"])
+
     if use_qlora:
         print("[GODMODE] QLoRA (4-bit) ENABLED")
         bnb_config = BitsAndBytesConfig(
@@ -243,23 +659,29 @@ def load_model(cfg: UltraQLoRAConfig):
             bnb_4bit_compute_dtype=torch.bfloat16,
             bnb_4bit_use_double_quant=True,
             bnb_4bit_quant_type="nf4",
+            # pack 4-bit weights in bf16 buckets (FSDP/DDP-friendly)
+            bnb_4bit_quant_storage=torch.bfloat16,
         )
-        model = AutoModelForCausalLM.from_pretrained(
-            cfg.model_name,
-            quantization_config=bnb_config,
-            device_map="auto",
-        )
+        # non-quantized params (norms, LoRA adapters) match the compute dtype
+        load_kwargs.setdefault("torch_dtype", torch.bfloat16)
+        model = load_quantized(cfg.model_name, bnb_config, load_kwargs)
         model = prepare_model_for_kbit_training(model)
     else:
-        print("[GODMODE] Falling back to LoRA (full precision)")
-        model = AutoModelForCausalLM.from_pretrained(cfg.model_name)
+        print("[GODMODE] Plain LoRA (no quantization)")
+        model = AutoModelForCausalLM.from_pretrained(cfg.model_name, **load_kwargs)
         if device == "cuda":
             model.to("cuda")
 
+    # trade recompute for activation memory on long sequences
+    model.gradient_checkpointing_enable(
+        gradient_checkpointing_kwargs={"use_reentrant": False}
+    )
+    model.config.use_cache = False
+
     lora_cfg = LoraConfig(
         r=cfg.lora_r,
         lora_alpha=cfg.lora_alpha,
-        target_modules=TARGET_MODULES_QWEN,
+        target_modules=discover_lora_targets(model),
         lora_dropout=cfg.lora_dropout,
         bias="none",
         task_type="CAUSAL_LM",
@@ -267,6 +689,15 @@ def load_model(cfg: UltraQLoRAConfig):
     model = get_peft_model(model, lora_cfg)
     model.print_trainable_parameters()
 
+    # fuse the small LoRA matmuls (plain LoRA only)
+    if cfg.compile and hasattr(torch, "compile") and device == "cuda":
+        if use_qlora:
+            # Trainer rejects compiled quantized models outright
+            print("[GODMODE] Skipping torch.compile: not supported with 4-bit QLoRA")
+        else:
+            print("[GODMODE] torch.compile (mode=reduce-overhead)")
+            model = torch.compile(model, mode="reduce-overhead", dynamic=True)
+
     return model
 
 
@@ -274,41 +705,88 @@ def load_model(cfg: UltraQLoRAConfig):
 # TRAIN LOOP
 # ---------------------------------------------------------
 
-def train(cfg: UltraQLoRAConfig):
-    os.makedirs(cfg.out_dir, exist_ok=True)
+class CausalLMCollator(DataCollatorForLanguageModeling):
+    """CLM collator that masks labels by attention_mask, not pad_token_id.
 
-    tokenizer = AutoTokenizer.from_pretrained(cfg.model_name)
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
-    tokenizer.padding_side = "right"
+    pad_token falls back to eos_token, so comparing against pad_token_id
+    would also drop the EOS separators between packed documents.
+    """
 
-    raw = load_ultra_dataset(cfg.data_files)
+    def torch_call(self, examples):
+        batch = super().torch_call(examples)
+        labels = batch["input_ids"].clone()
+        labels[batch["attention_mask"] == 0] = -100
+        batch["labels"] = labels
+        return batch
 
-    # Convert raw→tokenized
-    def tokenize(batch):
-        texts = [extract_text(x) for x in batch["__raw__"]]
-        res = tokenizer(
-            texts,
-            max_length=cfg.max_seq_len,
-            truncation=True,
-            padding=False
+
+class DropColumnsCollator:
+    """Strip bookkeeping columns (e.g. length) before the real collator."""
+
+    def __init__(self, collator, drop: List[str]):
+        self.collator = collator
+        self.drop = set(drop)
+
+    def __call__(self, features: List[Dict[str, Any]]):
+        return self.collator(
+            [{k: v for k, v in f.items() if k not in self.drop} for f in features]
         )
-        res["labels"] = res["input_ids"].copy()
-        return res
 
-    tokenized = raw.map(tokenize, batched=True, remove_columns=raw.column_names)
 
-    # -----------------------
-    # Train / Eval split
-    # -----------------------
-    split_idx = int(len(tokenized) * (1 - cfg.eval_ratio))
-    train_ds = tokenized.select(range(0, split_idx))
-    eval_ds = tokenized.select(range(split_idx, len(tokenized)))
+def train(cfg: UltraQLoRAConfig):
+    # allocator config is read on first CUDA allocation, so set it first
+    os.environ.setdefault(
+        "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512"
+    )
+    # TF32 for the residual fp32 matmuls (norms, head) on Ampere+
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
+    os.makedirs(cfg.out_dir, exist_ok=True)
+
+    tokenizer = get_tokenizer(cfg.model_name)
+
+    if cfg.stream:
+        # constant memory: shards are read, tokenized and packed on the fly
+        train_ds = build_stream_dataset(cfg)
+        eval_ds = None
+        print("[GODMODE] Streaming dataset (eval split disabled)")
+    else:
+        tokenized = build_tokenized_dataset(cfg)
+
+        # -----------------------
+        # Train / Eval split
+        # -----------------------
+        # contiguous step-1 ranges: datasets serves these as zero-copy
+        # Arrow slices instead of building an indices mapping
+        split_idx = int(len(tokenized) * (1 - cfg.eval_ratio))
+        train_ds = tokenized.select(range(split_idx))
+        eval_ds = tokenized.select(range(split_idx, len(tokenized)))
 
-    print(f"[GODMODE] Train samples: {len(train_ds)}")
-    print(f"[GODMODE] Eval samples: {len(eval_ds)}")
+        print(f"[GODMODE] Train samples: {len(train_ds)}")
+        print(f"[GODMODE] Eval samples: {len(eval_ds)}")
 
     model = load_model(cfg)
+    device = resolve_device(cfg)
+
+    # frozen base weights never hold grads; Trainer only hands the
+    # requires_grad (LoRA) params to the 8-bit optimizer
+    for p in model.parameters():
+        if not p.requires_grad:
+            p.grad = None
+
+    use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+
+    # labels = input_ids with padding → -100; lengths aligned for tensor cores
+    collator = CausalLMCollator(
+        tokenizer,
+        mlm=False,
+        pad_to_multiple_of=16 if use_bf16 else 8,
+    )
+    if not cfg.pack:
+        collator = DropColumnsCollator(collator, ["length"])
 
     training_args = TrainingArguments(
         output_dir=cfg.out_dir,
@@ -322,11 +800,22 @@ def train(cfg: UltraQLoRAConfig):
         save_total_limit=3,
         report_to=[],
         remove_unused_columns=False,
-        bf16=(torch.cuda.is_available() and torch.cuda.is_bf16_supported()),
-        optim="paged_adamw_8bit" if (cfg.device=="cuda" and HAS_BNB) else "adamw_torch",
+        # packed blocks are uniform; otherwise batch similar lengths together
+        group_by_length=not cfg.pack,
+        length_column_name="length",
+        gradient_checkpointing=True,
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+        torch_compile=False,  # already compiled in load_model
+        # collate + pinned H2D copies overlap with the GPU step
+        dataloader_num_workers=min(8, os.cpu_count() or 2),
+        dataloader_pin_memory=(device == "cuda"),
+        dataloader_prefetch_factor=4,
+        dataloader_persistent_workers=True,
+        bf16=use_bf16,
+        optim="paged_adamw_8bit" if (device == "cuda" and HAS_BNB) else "adamw_torch",
     )
 
-    if cfg.device == "cpu":
+    if device == "cpu":
         training_args.no_cuda = True
 
     trainer = Trainer(
@@ -334,19 +823,25 @@ def train(cfg: UltraQLoRAConfig):
         args=training_args,
         train_dataset=train_ds,
         eval_dataset=eval_ds,
+        data_collator=collator,
     )
 
     print("[GODMODE] Training…")
     trainer.train()
 
     print("[GODMODE] Saving final weights…")
-    trainer.model.save_pretrained(cfg.out_dir)
+    # unwrap torch.compile's OptimizedModule before saving adapters
+    getattr(trainer.model, "_orig_mod", trainer.model).save_pretrained(cfg.out_dir)
     tokenizer.save_pretrained(cfg.out_dir)
 
     print("[GODMODE] DONE.")
 
 
 def main():
+    # one level of parallelism: Rust threads only when map runs in-process
+    # (dataset map / dataloader workers already fan out over processes)
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "true" if NUM_PROC == 1 else "false")
+
     cfg = parse_args()
     train(cfg)
 
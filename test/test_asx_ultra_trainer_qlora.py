@@ -0,0 +1,200 @@
+"""Tests for python/local/asx_ultra_trainer_qlora.py helpers."""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "python", "local"))
+
+import pytest
+import torch.nn as nn
+from peft import LoraConfig, get_peft_model
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import (
+    GPT2Config,
+    GPT2LMHeadModel,
+    LlamaConfig,
+    LlamaForCausalLM,
+    PreTrainedTokenizerFast,
+)
+
+import asx_ultra_trainer_qlora as trainer
+
+EOS = 0
+
+
+def make_tokenizer():
+    # pad == eos, same as the Qwen presets
+    vocab = {"<eos>": EOS, "a": 1, "b": 2}
+    tok = Tokenizer(models.WordLevel(vocab, unk_token="<eos>"))
+    tok.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    return PreTrainedTokenizerFast(tokenizer_object=tok, eos_token="<eos>", pad_token="<eos>")
+
+
+def test_collator_keeps_eos_labels():
+    collator = trainer.CausalLMCollator(make_tokenizer(), mlm=False, pad_to_multiple_of=8)
+    batch = collator([{"input_ids": [1, EOS, 2]}, {"input_ids": [1, 2, EOS, 1, EOS]}])
+
+    assert batch["input_ids"].shape == (2, 8)
+    assert batch["labels"][0].tolist() == [1, EOS, 2] + [-100] * 5
+    assert batch["labels"][1].tolist() == [1, 2, EOS, 1, EOS] + [-100] * 3
+
+
+def write_jsonl(path, rows):
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+
+
+def make_cfg(tmp_path, data_files, **kw):
+    tok_dir = tmp_path / "tok"
+    make_tokenizer().save_pretrained(tok_dir)
+    return trainer.UltraQLoRAConfig(
+        model_name=str(tok_dir),
+        data_files=[str(p) for p in data_files],
+        out_dir=str(tmp_path / "out"),
+        max_seq_len=4,
+        **kw,
+    )
+
+
+def test_tokenized_cache_skips_loading_on_hit(tmp_path, monkeypatch):
+    data = tmp_path / "data.jsonl"
+    write_jsonl(data, [{"text": "a b a"}, {"text": "b b"}])
+    cfg = make_cfg(tmp_path, [data], dedup=False)
+
+    first = trainer.build_tokenized_dataset(cfg)
+    assert first["input_ids"] == [[1, 2, 1, EOS], [2, 2, EOS]]
+
+    def fail(*args, **kwargs):
+        raise AssertionError("raw data loaded on a cache hit")
+
+    monkeypatch.setattr(trainer, "load_ultra_dataset", fail)
+    assert trainer.build_tokenized_dataset(cfg)["input_ids"] == first["input_ids"]
+
+
+def test_batch_texts_matches_extract_text():
+    batches = [
+        {"text": ["plain", "also plain"]},
+        {"text": ["a", None], "prompt": ["p", "q"], "completion": ["c", "d"]},
+        {"instruction": ["i", "j"], "input": ["", "x"], "output": ["o", "y"]},
+        {"id": [1], "meta": [{"k": "v"}]},
+    ]
+    for batch in batches:
+        rows = list(trainer._rows(batch))
+        assert trainer.batch_texts(batch) == [trainer.extract_text(r) for r in rows]
+
+
+def test_dedup_dataset_keeps_first_occurrence(tmp_path):
+    data = tmp_path / "dup.jsonl"
+    write_jsonl(data, [
+        {"prompt": "p", "completion": "c"},
+        {"prompt": "q", "completion": "d"},
+        {"prompt": "p", "completion": "c"},
+        {"prompt": "q", "completion": "e"},
+    ])
+
+    ds = trainer.dedup_dataset(trainer.load_ultra_dataset([str(data)]))
+    assert ds["completion"] == ["c", "d", "e"]
+
+
+def test_flatten_obj_output_is_pinned():
+    obj = {"b": 1, "a": ["é", 2, "x/y"]}
+    expected = '{"a":["é",2,"x/y"],"b":1}'
+
+    assert trainer.flatten_obj(obj) == expected
+    # the no-orjson fallback must produce the same text
+    assert trainer._dumps_stdlib(obj) == expected
+    assert trainer.flatten_obj([{"k": None}]) == '[{"k":null}]'
+
+
+def test_estimate_params_from_config(tmp_path):
+    llama = LlamaConfig(
+        hidden_size=64, num_hidden_layers=2, intermediate_size=128, vocab_size=100
+    )
+    llama.save_pretrained(tmp_path / "llama")
+    # 2 * (4*64*64 attn + 3*64*128 gated MLP) + 100*64 embeddings
+    assert trainer.estimate_params(str(tmp_path / "llama")) == 88_320
+
+    gpt2 = GPT2Config(n_embd=32, n_layer=2, n_head=2, vocab_size=50)
+    gpt2.save_pretrained(tmp_path / "gpt2")
+    # no intermediate_size: 4h^2 attn + 8h^2 (4x) MLP per layer
+    assert trainer.estimate_params(str(tmp_path / "gpt2")) == 2 * 12 * 32 * 32 + 50 * 32
+
+
+def tiny_llama():
+    return LlamaForCausalLM(LlamaConfig(
+        hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+        num_key_value_heads=2, intermediate_size=32, vocab_size=10,
+    ))
+
+
+def test_discover_lora_targets_matches_candidates():
+    assert trainer.discover_lora_targets(tiny_llama()) == [
+        "q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj",
+    ]
+
+    gpt2 = GPT2LMHeadModel(GPT2Config(n_embd=16, n_layer=1, n_head=2, vocab_size=10))
+    # GPT-2 projections are Conv1D; lm_head is never a candidate
+    assert trainer.discover_lora_targets(gpt2) == ["c_attn", "c_proj"]
+
+
+def test_discover_lora_targets_fallback_excludes_lm_head():
+    model = nn.Module()
+    model.fc_in = nn.Linear(4, 4)
+    model.fc_out = nn.Linear(4, 4)
+    model.lm_head = nn.Linear(4, 10)
+    assert trainer.discover_lora_targets(model) == ["fc_in", "fc_out"]
+
+
+def test_discover_lora_targets_raises_without_linears():
+    model = nn.Module()
+    model.lm_head = nn.Linear(4, 10)
+    model.norm = nn.LayerNorm(4)
+    with pytest.raises(RuntimeError):
+        trainer.discover_lora_targets(model)
+
+
+def test_tar_without_stream_names_the_flag(tmp_path):
+    shard = tmp_path / "shard-000.tar"
+    shard.write_bytes(b"")
+    with pytest.raises(RuntimeError, match="--stream"):
+        trainer.load_ultra_dataset([str(shard)])
+
+
+def test_adapter_names_base_model_on_snapshot_hit_and_miss(tmp_path, monkeypatch):
+    base = tmp_path / "base"
+    tiny_llama().save_pretrained(base)
+    monkeypatch.setattr(trainer, "QLORA_CACHE_ROOT", str(tmp_path / "snapshots"))
+
+    for run in ("miss", "hit"):
+        model = trainer.load_quantized(str(base), None, {})
+        lora = LoraConfig(r=2, target_modules=["q_proj"], task_type="CAUSAL_LM")
+        out = tmp_path / run
+        get_peft_model(model, lora).save_pretrained(out)
+
+        with open(out / "adapter_config.json") as f:
+            assert json.load(f)["base_model_name_or_path"] == str(base)
+
+    assert os.path.isdir(trainer.qlora_snapshot_dir(str(base)))
+
+
+def test_no_pack_adds_length_and_collator_drops_it(tmp_path):
+    data = tmp_path / "data.jsonl"
+    write_jsonl(data, [{"text": "a b a a b"}, {"text": "b"}])
+    cfg = make_cfg(tmp_path, [data], dedup=False, pack=False)
+
+    ds = trainer.build_tokenized_dataset(cfg)
+    assert ds.column_names == ["input_ids", "length"]
+    # truncated to max_seq_len, no EOS appended
+    assert ds["input_ids"] == [[1, 2, 1, 1], [2]]
+    assert ds["length"] == [4, 1]
+
+    collator = trainer.DropColumnsCollator(
+        trainer.CausalLMCollator(make_tokenizer(), mlm=False, pad_to_multiple_of=8),
+        ["length"],
+    )
+    batch = collator([ds[0], ds[1]])
+
+    assert "length" not in batch
+    assert batch["labels"][1].tolist() == [2] + [-100] * 7